@@ -1,93 +1,233 @@
 import pickle
-from os import remove
-from os.path import basename, dirname, join
-from random import sample
+from concurrent.futures import Executor, Future
+from copy import copy
+from io import BytesIO
 from typing import Union
 from zipfile import ZipFile
 
 import numpy as np
-from keras import Model
-from keras.callbacks import History
-from keras.engine.saving import load_model
-from keras.models import clone_model
-from keras.utils import to_categorical
+import tensorflow as tf
+from tensorflow.keras import Model
+from tensorflow.keras.models import clone_model
+from tensorflow.keras.optimizers import Optimizer
 
+from core.model import atari_skiing_model, fixed_batch_model
 from core.policy import EGreedyPolicy
 
+# Compile the train step with XLA only on a GPU, because on the CPU it makes the ConvLSTM layers many times slower.
+_JIT_COMPILE_TRAIN_STEP = bool(tf.config.list_physical_devices('GPU'))
 
-class ExperienceReplayMemory(object):
-    """ Implements a Ring Buffer with an extra function which randomly samples elements from it,
-    in order to be used as an Experience Replay Memory for the agent. """
 
-    def __init__(self, size: int):
+class LazyFramesReplayMemory(object):
+    """ Implements an Experience Replay Memory which stores every frame only once,
+    along with the action and the reward which led to it.
+    The frames are kept in preallocated arrays, which are used as a Ring Buffer,
+    and the states are stacked lazily from them, only when they are sampled. """
+
+    # The arrays which hold the frames and their transitions.
+    _ARRAYS = ('frames', 'actions', 'rewards', 'previous')
+
+    def __init__(self, size: int, observation_space_shape: tuple):
         # Check size value.
         if size < 1:
             raise ValueError('Memory size must be a positive integer. Got {} instead.'.format(size))
 
-        # Initialize array.
-        # Allocate one extra element, so that self.start == self.end always means the buffer is EMPTY,
-        # whereas if exactly the right number of elements is allocated,
-        # it also means the buffer is full. This greatly simplifies the rest of the code.
-        self.data = [None] * (size + 1)
-        # Initialize start pointer.
-        self.start = 0
-        # Initialize end pointer.
-        self.end = 0
+        self.size = size
+        self.frame_history = observation_space_shape[0]
 
-    def append(self, element) -> None:
+        # Initialize arrays.
+        # Every frame is stored in the position of its id modulo the size,
+        # along with the id of the previous frame of the same episode, or -1 if there is none.
+        self.frames = np.empty((size,) + observation_space_shape[1:], dtype=np.uint8)
+        self.actions = np.empty(size, dtype=np.int8)
+        self.rewards = np.empty(size, dtype=np.float32)
+        self.previous = np.empty(size, dtype=np.int64)
+        # Initialize the number of frames appended so far, which is used as the id of the next frame.
+        self.appended = 0
+        # Initialize the id of the last frame appended for every environment.
+        self.last_appended = dict()
+
+    def _append_frames(self, frames: np.ndarray, actions: np.ndarray, rewards: np.ndarray, previous: np.ndarray,
+                       lanes: np.ndarray) -> None:
         """
-        Appends an element to the memory.
+        Appends a batch of frames to the memory, one for each of the given environments.
 
-        :param element: the element to append.
+        :param frames: the frames to append.
+        :param actions: the actions which led to the frames.
+        :param rewards: the rewards which were received until the frames.
+        :param previous: the ids of the previous frames of the same episodes, or -1 if there are none.
+        :param lanes: the environments to which the frames belong.
         """
-        # Add the element to the end of the memory.
-        self.data[self.end] = element
-        # Increment the end pointer.
-        self.end = (self.end + 1) % len(self.data)
+        ids = np.arange(self.appended, self.appended + len(lanes))
+        positions = ids % self.size
 
-        # Remove the first element by incrementing start pointer, if the memory size has been reached.
-        if self.end == self.start:
-            self.start = (self.start + 1) % len(self.data)
+        # Write the frames to their positions, overwriting the oldest ones if the memory size has been reached.
+        self.frames[positions] = frames
+        self.actions[positions] = actions
+        self.rewards[positions] = rewards
+        self.previous[positions] = previous
 
-    def randomly_sample(self, num_items: int) -> list:
+        self.last_appended.update(zip(lanes.tolist(), ids.tolist()))
+        self.appended += len(lanes)
+
+    def append_first_frames(self, frames: np.ndarray, lanes: np.ndarray) -> None:
         """
-        Samples a number of items from the memory randomly.
+        Appends the first frames of the episodes played in a number of environments.
 
-        :param num_items: the number of the random items to be sampled.
-        :return: the items.
+        :param frames: the frames to append.
+        :param lanes: the environments to which the frames belong.
         """
-        # Sample a random number of memory indexes, which result in non empty contents and return the contents.
-        indexes = sample(range(len(self)), num_items)
-        return [self[idx] for idx in indexes]
+        self._append_frames(frames, 0, 0, -1, lanes)
 
-    def __getitem__(self, idx):
-        return self.data[(self.start + idx) % len(self.data)]
+    def append_frames(self, frames: np.ndarray, actions: np.ndarray, rewards: np.ndarray, lanes: np.ndarray) -> None:
+        """
+        Appends a batch of frames, each of which follows the last frame appended for the same environment.
 
-    def __len__(self):
-        if self.end < self.start:
-            return self.end + len(self.data) - self.start
-        else:
-            return self.end - self.start
+        :param frames: the frames to append.
+        :param actions: the actions which led to the frames.
+        :param rewards: the rewards which were received until the frames.
+        :param lanes: the environments to which the frames belong.
+        """
+        previous = np.fromiter((self.last_appended[lane] for lane in lanes.tolist()), np.int64, len(lanes))
+        self._append_frames(frames, actions, rewards, previous, lanes)
+
+    def _oldest(self) -> int:
+        """
+        Returns the id of the oldest frame which has not been overwritten.
+
+        :return: the id.
+        """
+        return self.appended - len(self)
+
+    def _stack_frames(self, ids: np.ndarray, out: np.ndarray) -> np.ndarray:
+        """
+        Stacks the frame histories which end with a batch of frames.
+
+        :param ids: the ids of the newest frames.
+        :param out: the array to write the stacks to, whose second dimension is the number of frames to be stacked.
+        :return: the stacks, with the newest frames first.
+        """
+        oldest = self._oldest()
+
+        for frame in range(out.shape[1]):
+            # Gather the frames straight into the stacks, wrapping the ids around the memory size.
+            np.take(self.frames, ids, axis=0, out=out[:, frame], mode='wrap')
+
+            # Move to the previous frames, or keep repeating the first ones if they do not exist.
+            previous = np.take(self.previous, ids, mode='wrap')
+            ids = np.where(previous >= oldest, previous, ids)
 
-    def __iter__(self):
-        for i in range(len(self)):
-            yield self[i]
+        return out
+
+    def randomly_sample(self, num_items: int, out: [np.ndarray] = None) -> [np.ndarray]:
+        """
+        Samples a number of transitions from the memory randomly.
+        The current and the next state of a transition share all their frames but one,
+        so both of them are returned in a single stack, which is one frame longer than a state.
+        The next state is made of the stack's first frames and the current state of its last frames.
+
+        :param num_items: the number of the random transitions to be sampled.
+        :param out: the arrays to write the transitions' states, the actions and the rewards to,
+         or None to allocate new ones.
+        :return: the transitions' states, the actions and the rewards.
+        """
+        oldest = self._oldest()
+        ids = np.random.randint(oldest, self.appended, num_items)
+        invalid = np.take(self.previous, ids, mode='wrap') < oldest
+
+        # Check that there is a frame to be redrawn into, so that the redrawing cannot go on forever.
+        if invalid.any() and not (self.previous[:len(self)] >= oldest).any():
+            raise ValueError('The memory holds no transition to be sampled. '
+                             'Consider a memory size greater than {}.'.format(self.size))
+
+        while invalid.any():
+            # Redraw the frames which begin an episode, or whose previous frame has been overwritten, in place.
+            ids[invalid] = np.random.randint(oldest, self.appended, np.count_nonzero(invalid))
+            invalid = np.take(self.previous, ids, mode='wrap') < oldest
+
+        if out is None:
+            out = np.empty((num_items, self.frame_history + 1) + self.frames.shape[1:], dtype=np.uint8), \
+                np.empty(num_items, dtype=self.actions.dtype), np.empty(num_items, dtype=self.rewards.dtype)
+
+        states, actions, rewards = out
+        self._stack_frames(ids, states)
+        np.take(self.actions, ids, out=actions, mode='wrap')
+        np.take(self.rewards, ids, out=rewards, mode='wrap')
+
+        return out
+
+    def __len__(self):
+        return min(self.appended, self.size)
+
+    def __copy__(self):
+        # Copy the arrays, so that the copy is not affected by the frames appended afterwards.
+        # Only their written part is copied, since the rest of them is never read before it is written.
+        memory = object.__new__(type(self))
+        memory.__dict__.update(self.__dict__)
+        written = len(self)
+        for name in self._ARRAYS:
+            array = getattr(self, name)
+            copied = np.empty_like(array)
+            copied[:written] = array[:written]
+            setattr(memory, name, copied)
+        memory.last_appended = self.last_appended.copy()
+        return memory
+
+    def __getstate__(self):
+        # Pickle only the written part of the arrays, so that a memory which is not full is not saved whole.
+        state = self.__dict__.copy()
+        written = len(self)
+        for name in self._ARRAYS:
+            state[name] = state[name][:written]
+        return state
+
+    def __setstate__(self, state):
+        # Reallocate the arrays to the memory size, filling in their written part.
+        self.__dict__.update(state)
+        for name in self._ARRAYS:
+            written = getattr(self, name)
+            array = np.empty((self.size,) + written.shape[1:], dtype=written.dtype)
+            array[:len(written)] = written
+            setattr(self, name, array)
 
 
 class DQN(object):
     def __init__(self, model: Model, target_model_change: int, gamma: float, batch_size: int,
                  observation_space_shape: tuple, action_size: int, policy: EGreedyPolicy, target_model: Model = None,
-                 memory_size: int = None, memory: ExperienceReplayMemory = None):
+                 memory_size: int = None, memory: LazyFramesReplayMemory = None, fit_batches: int = 1):
         self.model = model
         self.target_model_change = target_model_change
-        self.memory = ExperienceReplayMemory(memory_size) if memory is None else memory
+        self.memory = LazyFramesReplayMemory(memory_size, observation_space_shape) if memory is None else memory
         self.gamma = gamma
-        self.batch_size = batch_size
         self.observation_space_shape = observation_space_shape
         self.action_size = action_size
         self.policy = policy
+        self.fit_batches = fit_batches
         self.target_model = self._create_target_model() if target_model is None else target_model
         self.steps_from_update = 0
+        # Set the batch size after the models, because the views of the models used for the training depend on it.
+        self.batch_size = batch_size
+        # Create the optimizer's variables now, since they cannot be created inside the train step's graph loop.
+        self.model.optimizer.build(self.model.trainable_variables)
+        # Initialize the sampled mini batches' buffers, which are allocated when first used.
+        self._mini_batches = None
+        # Keep the input of the greedy action selection in a persistent variable, placed on the model's device,
+        # so that its buffer is reused for every batch of the same size, instead of being allocated on every action.
+        self._greedy_states = tf.Variable(tf.zeros((0,) + observation_space_shape, tf.uint8), trainable=False,
+                                          shape=(None,) + observation_space_shape)
+
+    @property
+    def batch_size(self) -> int:
+        return self._batch_size
+
+    @batch_size.setter
+    def batch_size(self, batch_size: int) -> None:
+        self._batch_size = batch_size
+        # Train through views of the models with the batch size fixed, which share their weights,
+        # so that the train step is specialized for its static shapes, while the models serve batches of any size.
+        # The views are rebuilt whenever the batch size changes, so that they never keep an older one.
+        self._train_model = fixed_batch_model(self.model, batch_size)
+        self._train_target_model = fixed_batch_model(self.target_model, batch_size)
 
     def _create_target_model(self) -> Model:
         """
@@ -102,176 +242,273 @@ class DQN(object):
 
         return target_model
 
-    def _get_mini_batch(self) -> [np.ndarray]:
+    def _get_mini_batches(self, batches: int) -> [np.ndarray]:
         """
-        Samples a random mini batch from the replay memory.
+        Samples a number of random mini batches from the replay memory, at once.
 
-        :return: the current state batch, the actions batch, the rewards batch and the next state batch
+        :param batches: the number of mini batches.
+        :return: the transitions' state batches, the actions batches and the rewards batches,
+         each one of them concatenated.
         """
-        # Randomly sample a mini batch.
-        mini_batch = self.memory.randomly_sample(self.batch_size)
+        samples = batches * self.batch_size
 
-        # Initialize arrays.
-        current_state_batch, next_state_batch, actions, rewards = \
-            np.empty(((self.batch_size,) + self.observation_space_shape)), \
-            np.empty(((self.batch_size,) + self.observation_space_shape)), \
-            np.empty(self.batch_size), \
-            np.empty(self.batch_size)
+        # Allocate the mini batches' buffers for the most samples requested so far, reallocating them only if more
+        # are requested, and sample fewer into their beginning.
+        # Since the buffers are reused, a fit which is run by an executor must finish before the next one is requested.
+        if self._mini_batches is None or len(self._mini_batches[2]) < samples:
+            self._mini_batches = self.memory.randomly_sample(samples)
+            return self._mini_batches
+
+        # Randomly sample the mini batches. The states are kept as uint8, since the model converts them itself.
+        return self.memory.randomly_sample(samples, [buffer[:samples] for buffer in self._mini_batches])
+
+    @tf.function
+    def _predict_greedy_actions(self) -> tf.Tensor:
+        """
+        Predicts the actions with the highest QValues, for the batch of states held by the greedy states' variable.
+        The prediction is compiled once, for batches of any size.
+
+        :return: the action numbers.
+        """
+        actions_mask = tf.ones((tf.shape(self._greedy_states)[0], self.action_size))
+        return tf.argmax(self.model([self._greedy_states, actions_mask], training=False), axis=1)
 
-        # Get values from the mini batch.
-        for idx, val in enumerate(mini_batch):
-            current_state_batch[idx] = val[0]
-            actions[idx] = val[1]
-            rewards[idx] = val[2]
-            next_state_batch[idx] = val[3]
+    def _greedy_actions(self, current_state: np.ndarray) -> np.ndarray:
+        """
+        Takes the actions with the highest QValues, for a batch of states.
 
-        return current_state_batch, actions, rewards, next_state_batch
+        :param current_state: the batch of states.
+        :return: the action numbers.
+        """
+        self._greedy_states.assign(current_state)
+        return self._predict_greedy_actions().numpy()
 
-    def take_action(self, current_state: np.ndarray, episode: int) -> int:
+    def take_action(self, current_state: np.ndarray, episode: int) -> np.ndarray:
         """
-        Takes an action based on the policy.
+        Takes an action for every state of a batch, based on the policy.
 
-        :param current_state: the state for which the action will be taken.
+        :param current_state: the batch of states for which the actions will be taken.
         :param episode: the current episode.
-        :return: the action number.
+        :return: the action numbers.
+        """
+        return self.policy.take_action(self._greedy_actions, current_state, episode)
+
+    def begin_memory_episodes(self, frames: np.ndarray, lanes: np.ndarray) -> None:
         """
-        return self.policy.take_action(self.model, current_state, episode)
+        Adds the first frames of a number of episodes to the agent's memory.
 
-    def append_to_memory(self, current_state: np.ndarray, action: int, reward: float, next_state: np.ndarray) -> None:
+        :param frames: the frames to add.
+        :param lanes: the environments in which the episodes are played.
         """
-        Adds values to the agent's memory.
+        self.memory.append_first_frames(frames, lanes)
 
-        :param current_state: the state to add.
-        :param action: the action to add.
-        :param reward: the reward to add.
-        :param next_state: the next state to add.
+    def append_batch_to_memory(self, frames: np.ndarray, actions: np.ndarray, rewards: np.ndarray,
+                               lanes: np.ndarray) -> None:
         """
-        self.memory.append((current_state, action, reward, next_state))
+        Adds a batch of values to the agent's memory, with a single write.
+
+        :param frames: the newest frames of the next states to add.
+        :param actions: the actions to add.
+        :param rewards: the rewards to add.
+        :param lanes: the environments in which the actions were taken.
+        """
+        self.memory.append_frames(frames, actions, rewards, lanes)
+
+    @tf.function
+    def _assign_weights_to_target_model(self) -> None:
+        """ Assigns the model's weights to the target model's variables, without copying them through NumPy. """
+        for target_weight, weight in zip(self.target_model.weights, self.model.weights):
+            target_weight.assign(weight)
 
     def update_target_model(self) -> None:
         """ Updates the target model. """
-        self.target_model.set_weights(self.model.get_weights())
+        self._assign_weights_to_target_model()
         self.steps_from_update = 0
 
-    def fit(self) -> Union[History, None]:
+    @tf.function(jit_compile=_JIT_COMPILE_TRAIN_STEP, reduce_retracing=True)
+    def _train_steps(self, transition_state_batches: tf.Tensor, actions: tf.Tensor, rewards: tf.Tensor,
+                     gamma: tf.Tensor) -> tf.Tensor:
         """
-        Fits the agent.
-
-        :return: the fit history.
+        Takes an optimization step of the model on every one of a number of mini batches, one after the other.
+        The target QValues are calculated inside the same step, which is compiled once, with XLA if there is a GPU,
+        instead of going through Keras' predict and fit on every call.
+
+        :param transition_state_batches: the transitions' state batches, holding both the current and the next states.
+        :param actions: the actions batches.
+        :param rewards: the rewards batches.
+        :param gamma: the discount factor.
+        :return: the mini batches' mean loss.
         """
-        # Fit only if the agent is not observing.
-        if not self.policy.observing:
-            # Increase the steps from update indicator.
-            self.steps_from_update += 1
+        batches = tf.shape(transition_state_batches)[0]
+        actions_mask = tf.ones((self.batch_size, self.action_size))
+        total_loss = tf.constant(0.0)
 
-            # Get the mini batches.
-            current_state_batch, actions, rewards, next_state_batch = self._get_mini_batch()
-
-            # Create the actions mask.
-            actions_mask = np.ones((self.batch_size, self.action_size))
+        # Loop over the mini batches with a graph loop, so that the model is traced once, for any number of them.
+        for batch in tf.range(batches):
             # Predict the next QValues.
-            next_q_values = self.target_model.predict([next_state_batch, actions_mask])
-            # Initialize the target QValues for the mini batch.
-            target_q_values = np.empty((self.batch_size,))
-
-            for i in range(self.batch_size):
-                # Update rewards, using the Deep Q Learning rule.
-                target_q_values[i] = rewards[i] + self.gamma * np.amax(next_q_values[i])
+            next_q_values = self._train_target_model([transition_state_batches[batch, :, :-1], actions_mask],
+                                                     training=False)
+            # Update rewards, using the Deep Q Learning rule.
+            target_q_values = rewards[batch] + gamma * tf.reduce_max(next_q_values, axis=1)
 
             # One hot encode the actions.
-            one_hot_actions = to_categorical(actions, self.action_size)
+            one_hot_actions = tf.one_hot(actions[batch], self.action_size)
             # One hot encode the target QValues.
-            one_hot_target_q_values = one_hot_actions * np.expand_dims(target_q_values, 1)
+            one_hot_target_q_values = one_hot_actions * tf.expand_dims(target_q_values, 1)
+
+            with tf.GradientTape() as tape:
+                q_values = self._train_model([transition_state_batches[batch, :, 1:], one_hot_actions], training=True)
+                loss = tf.reduce_mean(self.model.loss(one_hot_target_q_values, q_values))
+
+            gradients = tape.gradient(loss, self._train_model.trainable_variables)
+            self.model.optimizer.apply_gradients(zip(gradients, self._train_model.trainable_variables))
+            total_loss += loss
+
+        return total_loss / tf.cast(batches, tf.float32)
+
+    def _fit_mini_batches(self, transition_state_batch: np.ndarray, actions: np.ndarray, rewards: np.ndarray) -> float:
+        """
+        Fits the model to a number of mini batches, which are given concatenated.
+
+        :param transition_state_batch: the transitions' state batches, holding both the current and the next states.
+        :param actions: the actions batches.
+        :param rewards: the rewards batches.
+        :return: the fit's loss.
+        """
+        # Fit the model to the batches, split back to the mini batches.
+        batches_shape = (len(rewards) // self.batch_size, self.batch_size)
+        transition_state_shape = (self.observation_space_shape[0] + 1,) + self.observation_space_shape[1:]
+        loss = float(self._train_steps(transition_state_batch.reshape(batches_shape + transition_state_shape),
+                                       actions.reshape(batches_shape), rewards.reshape(batches_shape),
+                                       tf.constant(self.gamma, tf.float32)))
+
+        # Update the target model if necessary.
+        if self.steps_from_update >= self.target_model_change or self.target_model_change < 1:
+            print('Updating target model.')
+            self.update_target_model()
+            print('Target model has been successfully updated.')
+
+        return loss
+
+    def fit(self, executor: Executor = None, lanes: int = 1) -> Union[float, Future, None]:
+        """
+        Fits the agent to a number of mini batches.
+        The mini batches are sampled immediately, while the fit itself can be run by an executor,
+        so that the agent can keep playing and filling its memory in the meantime.
+
+        :param executor: the executor which fits the model, or None to fit it now.
+        :param lanes: the number of environments played since the previous fit, for each of which
+         the agent fits to its number of fit batches.
+        :return: the fit's loss, or its future if an executor has been used.
+        """
+        # Fit only if the agent is not observing and an environment has been played.
+        if not self.policy.observing and lanes > 0:
+            batches = self.fit_batches * lanes
+            # Increase the steps from update indicator, by the number of optimization steps.
+            self.steps_from_update += batches
 
-            # Fit the model to the batches.
-            history = self.model.fit([current_state_batch, one_hot_actions],
-                                     one_hot_target_q_values, epochs=1, batch_size=self.batch_size, verbose=0)
+            # Get the mini batches, concatenated.
+            mini_batches = self._get_mini_batches(batches)
 
-            # Update the target model if necessary.
-            if self.steps_from_update == self.target_model_change or self.target_model_change < 1:
-                print('Updating target model.')
-                self.update_target_model()
-                print('Target model has been successfully updated.')
+            if executor is None:
+                return self._fit_mini_batches(*mini_batches)
 
-            return history
+            return executor.submit(self._fit_mini_batches, *mini_batches)
 
-    def save_agent(self, filename_prefix: str = 'dqn') -> str:
+    def save_agent(self, filename_prefix: str = 'dqn', executor: Executor = None) -> Union[str, Future]:
         """
         Saves the agent.
+        Only a snapshot of the agent is taken immediately, while the zip can be written by an executor,
+        so that the agent can keep playing in the meantime.
+        The snapshot copies the written part of the replay memory, so once the memory is full,
+        every save stalls the game for a copy of the whole memory and holds a second one until the zip is written.
 
         :param filename_prefix: the agent's filename prefix.
-        :return: the filename.
+        :param executor: the executor which writes the zip, or None to write it now.
+        :return: the filename, or its future if an executor has been used.
         """
-        # Create filenames.
-        model_filename = 'model.h5'
-        target_model_filename = 'target_model.h5'
-        config_filename = 'config.pickle'
+        # Create filename.
         zip_filename = filename_prefix + '.zip'
 
-        # Save models.
-        self.model.save(model_filename)
-        self.target_model.save(target_model_filename)
+        # Copy the models' weights, since their architecture is recreated when they are loaded.
+        model_weights = self.model.get_weights()
+        target_model_weights = self.target_model.get_weights()
 
-        # Create configuration dict.
+        # Create configuration dict, copying everything that changes while the agent plays.
         config = dict({
             'target_model_change': self.target_model_change,
             'gamma': self.gamma,
             'batch_size': self.batch_size,
+            'fit_batches': self.fit_batches,
             'observation_space_shape': self.observation_space_shape,
             'action_size': self.action_size,
-            'policy': self.policy,
-            'memory': self.memory
+            'policy': copy(self.policy),
+            'memory': copy(self.memory)
         })
 
-        # Save configuration.
-        with open(config_filename, 'wb') as stream:
+        if executor is None:
+            return _write_agent_zip(zip_filename, model_weights, target_model_weights, config)
+
+        return executor.submit(_write_agent_zip, zip_filename, model_weights, target_model_weights, config)
+
+
+def _write_agent_zip(zip_filename: str, model_weights: list, target_model_weights: list, config: dict) -> str:
+    """
+    Writes the agent's models' weights and configuration to a zip.
+
+    :param zip_filename: the zip's filename.
+    :param model_weights: the model's weights.
+    :param target_model_weights: the target model's weights.
+    :param config: the agent's configuration.
+    :return: the zip's filename.
+    """
+    # Write models' weights and configuration straight into the zip, without any intermediate files.
+    with ZipFile(zip_filename, 'w') as model_zip:
+        with model_zip.open('model.npz', 'w') as stream:
+            np.savez(stream, *model_weights)
+        with model_zip.open('target_model.npz', 'w') as stream:
+            np.savez(stream, *target_model_weights)
+        with model_zip.open('config.pickle', 'w') as stream:
             pickle.dump(config, stream, protocol=pickle.HIGHEST_PROTOCOL)
 
-        # Zip models and configuration together.
-        with ZipFile(zip_filename, 'w') as model_zip:
-            model_zip.write(model_filename, basename(model_filename))
-            model_zip.write(target_model_filename, basename(target_model_filename))
-            model_zip.write(config_filename, basename(config_filename))
+    return zip_filename
 
-        # Remove files out of the zip.
-        remove(model_filename)
-        remove(target_model_filename)
-        remove(config_filename)
 
-        return zip_filename
+def _read_weights(model_zip: ZipFile, filename: str) -> list:
+    """
+    Reads a model's weights from a zip.
+
+    :param model_zip: the zip.
+    :param filename: the weights' filename in the zip.
+    :return: the weights, in the order of the model's weights.
+    """
+    with np.load(BytesIO(model_zip.read(filename))) as weights:
+        return [weights['arr_{}'.format(i)] for i in range(len(weights.files))]
 
 
-def load_dqn_agent(filename: str, custom_objects: dict) -> DQN:
+def load_dqn_agent(filename: str, optimizer: Optimizer) -> DQN:
     """
     Loads an agent from a file, using the given parameters.
 
     :param filename: the agent's filename.
-    :param custom_objects: custom_objects for the keras model.
+    :param optimizer: the optimizer to be used for the model's compilation.
     :return: the DQN agent.
     """
-    # Create filenames.
-    directory = dirname(filename)
-    model_filename = join(directory, 'model.h5')
-    target_model_filename = join(directory, 'target_model.h5')
-    config_filename = join(directory, 'config.pickle')
-
-    # Read models and memory.
+    # Read models' weights and configuration straight from the zip.
     with ZipFile(filename) as model_zip:
-        model_zip.extractall(directory)
-
-    # Load models.
-    model = load_model(model_filename, custom_objects=custom_objects)
-    target_model = load_model(target_model_filename, custom_objects=custom_objects)
-
-    # Load configuration.
-    with open(config_filename, 'rb') as stream:
-        config = pickle.load(stream)
-
-    # Remove files out of the zip.
-    remove(model_filename)
-    remove(target_model_filename)
-    remove(config_filename)
-
-    return DQN(model, config['target_model_change'], config['gamma'], config['batch_size'],
-               config['observation_space_shape'], config['action_size'], config['policy'], target_model,
-               memory=config['memory'])
+        model_weights = _read_weights(model_zip, 'model.npz')
+        target_model_weights = _read_weights(model_zip, 'target_model.npz')
+        with model_zip.open('config.pickle') as stream:
+            config = pickle.load(stream)
+
+    # Create the model, instead of deserializing it, and set its weights.
+    model = atari_skiing_model(config['observation_space_shape'], config['action_size'], optimizer)
+    model.set_weights(model_weights)
+
+    # Create the agent, which creates the target model as a copy of the model, and set the target model's weights.
+    dqn = DQN(model, config['target_model_change'], config['gamma'], config['batch_size'],
+              config['observation_space_shape'], config['action_size'], config['policy'], memory=config['memory'],
+              fit_batches=config['fit_batches'])
+    dqn.target_model.set_weights(target_model_weights)
+
+    return dqn
@@ -1,9 +1,10 @@
 from typing import Union
 
-from keras import Input, Model
-from keras.backend import cast
-from keras.layers import Lambda, Flatten, Dense, Multiply, ConvLSTM2D, BatchNormalization
-from keras.optimizers import Optimizer, adam, rmsprop, sgd, adagrad, adadelta, adamax
+from tensorflow.keras import Input, Model
+from tensorflow.keras.backend import cast
+from tensorflow.keras.layers import Lambda, Flatten, Dense, Multiply, ConvLSTM2D, BatchNormalization
+from tensorflow.keras.optimizers import Optimizer, Adam, RMSprop, SGD, Adagrad, Adadelta, Adamax
+from tensorflow.keras.optimizers.schedules import InverseTimeDecay
 
 # (last conv size + filter loss) * first conv stride, or first conv size if it is bigger.
 # ( 4 + 1 ) * 4 or 8
@@ -31,10 +32,11 @@ def atari_skiing_model(shape: tuple, action_size: int, optimizer: Optimizer) ->
     :return: the Keras Model.
     """
     # Create the input layers.
-    inputs = Input(shape, name='input')
+    # The frames are fed as uint8, so that they are converted to float only once, inside the model.
+    inputs = Input(shape, dtype='uint8', name='input')
     actions_input = Input((action_size,), name='input_mask')
     # Create a normalization layer.
-    normalized = Lambda(lambda x: x / 255.0, name='normalisation')(inputs)
+    normalized = Lambda(lambda x: cast(x, 'float32') / 255.0, name='normalisation')(inputs)
 
     # Create CNN-LSTM layers.
     conv_lstm2d_1 = ConvLSTM2D(16, (8, 8), strides=(4, 4), activation='relu', return_sequences=True,
@@ -59,9 +61,36 @@ def atari_skiing_model(shape: tuple, action_size: int, optimizer: Optimizer) ->
     return model
 
 
+def fixed_batch_model(model: Model, batch_size: int) -> Model:
+    """
+    Wraps a Keras Model with inputs of a static batch size, sharing the model's layers and weights.
+    Since every input shape is known when the graph is built, the convolution algorithms can be picked once for them.
+
+    :param model: the Keras Model to be wrapped.
+    :param batch_size: the static batch size.
+    :return: the fixed batch Keras Model.
+    """
+    # Create the input layers, with the same shapes and types as the model's, but with the batch size fixed.
+    inputs = [Input(batch_size=batch_size, shape=model_input.shape[1:], dtype=model_input.dtype, name=model_input.name)
+              for model_input in model.inputs]
+
+    return Model(inputs=inputs, outputs=model(inputs), name=model.name + '_fixed_batch')
+
+
+def _decayed_learning_rate(learning_rate: float, lr_decay: float) -> Union[float, InverseTimeDecay]:
+    """
+    Decays the learning rate on every update, as lr / (1 + lr_decay * updates).
+
+    :param learning_rate: the initial learning rate.
+    :param lr_decay: the learning rate's decay.
+    :return: the learning rate, or its schedule if it decays.
+    """
+    return InverseTimeDecay(learning_rate, 1, lr_decay) if lr_decay > 0 else learning_rate
+
+
 def initialize_optimizer(optimizer_name: str, learning_rate: float, beta1: float, beta2: float,
                          lr_decay: float, rho: float, fuzz: float, momentum: float) \
-        -> Union[adam, rmsprop, sgd, adagrad, adadelta, adamax]:
+        -> Union[Adam, RMSprop, SGD, Adagrad, Adadelta, Adamax]:
     """
     Initializes an optimizer based on the user's choices.
 
@@ -77,17 +106,17 @@ def initialize_optimizer(optimizer_name: str, learning_rate: float, beta1: float
     :return: the optimizer.
     """
     if optimizer_name == 'adam':
-        return adam(lr=learning_rate, beta_1=beta1, beta_2=beta2, decay=lr_decay)
+        return Adam(_decayed_learning_rate(learning_rate, lr_decay), beta_1=beta1, beta_2=beta2)
     elif optimizer_name == 'rmsprop':
-        return rmsprop(lr=learning_rate, rho=rho, epsilon=fuzz)
+        return RMSprop(learning_rate, rho=rho, epsilon=fuzz)
     elif optimizer_name == 'sgd':
-        return sgd(lr=learning_rate, momentum=momentum, decay=lr_decay)
+        return SGD(_decayed_learning_rate(learning_rate, lr_decay), momentum=momentum)
     elif optimizer_name == 'adagrad':
-        return adagrad(lr=learning_rate, decay=lr_decay)
+        return Adagrad(_decayed_learning_rate(learning_rate, lr_decay))
     elif optimizer_name == 'adadelta':
-        return adadelta(lr=learning_rate, rho=rho, decay=lr_decay)
+        return Adadelta(_decayed_learning_rate(learning_rate, lr_decay), rho=rho)
     elif optimizer_name == 'adamax':
-        return adamax(lr=learning_rate, beta_1=beta1, beta_2=beta2, decay=lr_decay)
+        return Adamax(_decayed_learning_rate(learning_rate, lr_decay), beta_1=beta1, beta_2=beta2)
     else:
         raise ValueError('An unexpected optimizer name has been encountered.')
 
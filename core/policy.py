@@ -1,70 +1,77 @@
-from random import randrange
+from typing import Callable
 
 import numpy as np
-from keras import Model
 
 
 class EGreedyPolicy(object):
     def __init__(self, e: float, final_e: float, epsilon_decay: float, total_observe_count: int, action_size: int):
-        self.e = e
+        self.initial_e = self.e = e
         self.final_e = final_e
         self.epsilon_decay = epsilon_decay
         self.total_observe_count = total_observe_count
         self.action_size = action_size
         self.observing_steps_taken = 0
+        self.decaying_steps_taken = 0
         self.observing = False if self.total_observe_count == 0 else True
         self.episode_observation_stopped = 0
 
-    def _decay_epsilon(self, episode: int) -> None:
+    def _decay_epsilon(self, episode: int, steps: int) -> None:
         """
         Decays the policy's epsilon.
 
         :param episode: the current episode.
+        :param steps: the number of actions which have been taken.
         """
         if self.e > self.final_e and not self.observing:
-            self.e -= self.epsilon_decay
-
-            if self.e < self.final_e:
-                self.e = self.final_e
+            # Calculate epsilon from the total number of decaying steps, instead of subtracting the decay repeatedly,
+            # so that no rounding error is accumulated.
+            self.decaying_steps_taken += steps
+            self.e = max(self.initial_e - self.epsilon_decay * self.decaying_steps_taken, self.final_e)
 
             if self.e == self.final_e:
                 print('Final epsilon reached at episode {}'.format(episode))
 
-    def _update_observation_state(self, episode: int) -> None:
+    def _update_observation_state(self, episode: int, steps: int) -> None:
         """
         Updates the observing value if needed.
 
         :param episode: the current episode.
+        :param steps: the number of actions which have been taken.
         """
         if self.observing:
-            self.observing_steps_taken += 1
-            if self.total_observe_count == self.observing_steps_taken:
+            self.observing_steps_taken += steps
+            if self.observing_steps_taken >= self.total_observe_count:
                 self.observing = False
                 self.episode_observation_stopped = episode
                 print('Agent has stopped observing at episode {}.\nThings are about to get serious!\nOr not...'
                       .format(self.episode_observation_stopped))
 
-    def take_action(self, model: Model, current_state: np.ndarray, episode: int) -> int:
+    def take_action(self, greedy_actions: Callable, current_state: np.ndarray, episode: int) -> np.ndarray:
         """
-        Takes an action based on the policy.
+        Takes an action for every state of a batch, based on the policy.
 
-        :param model: the model to use.
-        :param current_state: the state for which the action will be taken.
+        :param greedy_actions: the function which predicts the best actions for a batch of states.
+        :param current_state: the batch of states for which the actions will be taken.
         :param episode: the current episode.
-        :return: the action number.
+        :return: the action numbers.
         """
-        if np.random.rand() <= self.e or self.observing:
-            # Take random action.
-            action = randrange(self.action_size)
-        else:
-            # Take the best action.
-            q_value = model.predict([current_state, np.expand_dims(np.ones(self.action_size), 0)])
-            action = np.argmax(q_value[0])
+        batch_size = current_state.shape[0]
+
+        # Take random actions.
+        actions = np.random.randint(0, self.action_size, batch_size)
+
+        if not self.observing:
+            # Take the best actions, wherever a random action should not be taken.
+            best = np.random.rand(batch_size) > self.e
+
+            # Predict only if there is at least one best action to be taken and only for the states which need it.
+            if best.any():
+                actions[best] = greedy_actions(current_state[best])
 
         # Decay epsilon.
-        self._decay_epsilon(episode)
+        self._decay_epsilon(episode, batch_size)
 
         # Update observation state.
-        self._update_observation_state(episode)
+        self._update_observation_state(episode, batch_size)
 
-        return action
+        return actions
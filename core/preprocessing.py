@@ -1,43 +1,33 @@
 import numpy as np
+from numba import njit
 
+# The 0.299, 0.587 and 0.114 luminance weights, multiplied by 256.
+GREY_WEIGHTS = (77, 150, 29)
 
-def rgb2gray(rgb: np.ndarray) -> np.ndarray:
-    """
-    Converts an rgb image array to a grey image array.
 
-    :param rgb: the rgb image array.
-    :return: the converted array.
+@njit(cache=True, fastmath=True)
+def atari_preprocess(frames: np.ndarray, downsample_scale: int, out: np.ndarray) -> np.ndarray:
     """
-    return np.dot(rgb[..., :3], [0.2989, 0.5870, 0.1140]).astype(np.uint8)
-
-
-def downsample(img: np.ndarray, scale: int = 2) -> np.ndarray:
+    Prepossesses the given batch of atari frame arrays,
+    converting them into greyscale and downsampling them in a single pass.
+
+    :param frames: the atari frame arrays, with shape (batch, height, width, rgb).
+    :param downsample_scale: a scale to downsample the given arrays with.
+    :param out: the array to write the preprocessed frames to,
+     with shape (batch, ceil(height / downsample_scale), ceil(width / downsample_scale)).
+    :return: the preprocessed frame arrays.
     """
-    Downsamples an image array, by a scale factor.
-
-    :param img: the image to downsample.
-    :param scale: the downsampling scale factor.
-    :return: the downsampled image.
-    """
-    if scale < 2:
-        return img
-
-    return img[::scale, ::scale]
-
-
-def atari_preprocess(frame_array: np.ndarray, downsample_scale: int = 2) -> np.ndarray:
-    """
-    Prepossesses the given atari frame array.
-
-    :param frame_array: the atari frame array.
-    :param downsample_scale: a scale to downsample the given array with.
-    :return: the preprocessed frame array.
-    """
-    # Converting into greyscale since colors don't matter.
-    greyscale_frame = rgb2gray(frame_array)
-
-    # Downsampling the image.
-    resized_frame = downsample(greyscale_frame, downsample_scale)
-
-    # Reshape for batches, frames and color dimension and return.
-    return resized_frame[np.newaxis, np.newaxis, :, :, np.newaxis]
+    for i in range(out.shape[0]):
+        # Downsampling the image, by keeping only one pixel per scale step.
+        # The loops run over the output's pixels, so that no index has to be divided by the scale.
+        for row in range(out.shape[1]):
+            y = row * downsample_scale
+            for column in range(out.shape[2]):
+                x = column * downsample_scale
+                # Converting into greyscale since colors don't matter.
+                # The luminance weights are scaled by 256, so that the conversion stays in integer arithmetic.
+                out[i, row, column] = np.uint8(
+                    (GREY_WEIGHTS[0] * frames[i, y, x, 0] + GREY_WEIGHTS[1] * frames[i, y, x, 1] +
+                     GREY_WEIGHTS[2] * frames[i, y, x, 2]) >> 8)
+
+    return out
@@ -1,10 +1,11 @@
-from collections import Generator
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
-from random import randint
+from functools import partial
+from typing import Generator
 
 import gym
 import numpy as np
-from gym.wrappers import TimeLimit
+from gym.vector import VectorEnv
 from math import inf, ceil
 
 from core.agent import DQN
@@ -28,13 +29,53 @@ class GameResultSpecs:
     save_plots: bool = True
 
 
-_GameInfo = [np.ndarray, float, bool]
+_GameInfo = [np.ndarray, np.ndarray, np.ndarray]
+
+
+def _make_skiing_environment(record: bool, recording_name_prefix: str) -> gym.Env:
+    """
+    Makes a single skiing environment.
+    Defined at module level, so that it can be pickled and sent to the vector environment's subprocesses.
+
+    :param record: whether the environment should be recorded.
+    :param recording_name_prefix: the recording's name prefix.
+    :return: the skiing environment.
+    """
+    # Create the skiing environment.
+    environment = gym.make('SkiingDeterministic-v4')
+
+    # Record environment.
+    if record:
+        environment = gym.wrappers.Monitor(environment, recording_name_prefix, force=True)
+
+    return environment
+
+
+def _skip_rendering(frames: np.ndarray) -> None:
+    """
+    Used in place of rendering, when the frames should not be rendered.
+
+    :param frames: the frames which are not rendered.
+    """
+
+
+def _report_saved_agent(saved: Future) -> None:
+    """
+    Reports that an agent has been saved.
+    A failed save is not reported here, because its error is raised by the game, when it waits for the save.
+
+    :param saved: the future with the saved agent's filename.
+    """
+    if saved.exception() is None:
+        print('Agent has been successfully saved as {}.'.format(saved.result()))
 
 
 class Game(object):
-    def __init__(self, episodes: int, downsample_scale: int, agent_frame_history: int, steps_per_action: int,
-                 fit_frequency: int, no_operation: int, specs: GameResultSpecs, render: bool, record: bool):
+    def __init__(self, episodes: int, num_envs: int, downsample_scale: int, agent_frame_history: int,
+                 steps_per_action: int, fit_frequency: int, no_operation: int, specs: GameResultSpecs, render: bool,
+                 record: bool):
         self.episodes = episodes
+        self.num_envs = num_envs
         self.downsample_scale = downsample_scale
         self.agent_frame_history = agent_frame_history
         self.steps_per_action = steps_per_action
@@ -46,191 +87,318 @@ class Game(object):
 
         # Create the skiing environment.
         self._env, self.pixel_rows, self.pixel_columns, self.action_space_size = self._create_skiing_environment()
+        # Preallocate a buffer for the observations of the subprocess environments, if there are any.
+        # Every frame of theirs is copied into it once, before the next step of the same action is started,
+        # because that step writes over the shared memory while the copied frame is being processed.
+        self._observations = np.empty(self._env.observation_space.shape, dtype=np.uint8) if self.num_envs > 1 else None
+
+        # Choose how to render the frames once, so that no check is needed on every step.
+        # The renderer is imported only when it is used, so that its viewer's dependencies are not needed otherwise.
+        if self.render:
+            from game_engine.rendering import Renderer
+            self._renderer = Renderer()
+            self._render_frame = self._renderer.render
+        else:
+            self._renderer, self._render_frame = None, _skip_rendering
+
+        # Calculate the preprocessed frames' height and width once, since they do not change.
+        self.downsampled_rows = ceil(self.pixel_rows / self.downsample_scale)
+        self.downsampled_columns = ceil(self.pixel_columns / self.downsample_scale)
 
         # Create the observation space's shape.
-        self.observation_space_shape = (self.agent_frame_history,
-                                        ceil(self.pixel_rows / self.downsample_scale),
-                                        ceil(self.pixel_columns / self.downsample_scale),
-                                        1)
+        self.observation_space_shape = (self.agent_frame_history, self.downsampled_rows, self.downsampled_columns, 1)
+
+        # Preallocate the frames buffer, which holds the frame history of every environment as a ring,
+        # whose write head points to the newest frames, so that the older frames never need to be shifted.
+        self._frames = np.empty((self.num_envs,) + self.observation_space_shape, dtype=np.uint8)
+        self._head = 0
+        # Precompute the views of the frames buffer which are written for every head position,
+        # and the frame history positions, from the newest to the oldest, for every head position.
+        self._newest_frames = [self._frames[:, head, :, :, 0] for head in range(self.agent_frame_history)]
+        self._history_orders = [(head - np.arange(self.agent_frame_history)) % self.agent_frame_history
+                                for head in range(self.agent_frame_history)]
+        # Initialize the remaining no operation steps of every environment.
+        self._no_operations = np.zeros(self.num_envs, dtype=np.int64)
+        # Initialize the max score, the total score and the total huber loss of every environment's episode.
+        self._max_scores = np.full(self.num_envs, -inf)
+        self._total_scores = np.zeros(self.num_envs)
+        self._losses = np.zeros(self.num_envs, dtype=np.float32)
 
         # Create a scorer.
         self.scorer = Scorer(episodes, self.specs.info_interval_mean, self.specs.results_name_prefix)
 
+        # Create a single worker, which fits the agent while the environments are being played,
+        # along with the currently running fit and the environments which were played before it.
+        self._fit_executor = ThreadPoolExecutor(max_workers=1)
+        self._fitting, self._fitting_played = None, None
+
+        # Create a single worker, which writes the agent and the results to the disk, so that the game does not wait,
+        # along with the pending writes, whose errors are raised by the game.
+        self._io_executor = ThreadPoolExecutor(max_workers=1)
+        self._writes = []
+
         # Create a plotter.
         self.plotter = Plotter(self.episodes, self.specs.plots_name_prefix, self.specs.plot_train_results,
                                self.specs.save_plots)
 
-    def _create_skiing_environment(self) -> [TimeLimit, int, int, int]:
+    def _create_skiing_environment(self) -> [VectorEnv, int, int, int]:
         """
-        Creates a skiing environment.
+        Creates a vector of skiing environments, which are stepped in parallel.
 
-        :return: the skiing environment, the image's height, the image's width and the action space's size.
+        :return: the skiing environments, the image's height, the image's width and the action space's size.
         """
-        # Create the skiing environment.
-        environment = gym.make('SkiingDeterministic-v4')
-
-        # Record environment.
-        if self.record:
-            environment = gym.wrappers.Monitor(environment, self.specs.recording_name_prefix, force=True)
+        # Create the skiing environments' constructors, recording only the first environment.
+        env_fns = [partial(_make_skiing_environment, self.record and lane == 0, self.specs.recording_name_prefix)
+                   for lane in range(self.num_envs)]
+
+        # Step the environments in subprocesses, unless there is only one, which is not worth the overhead.
+        # The subprocesses write the observations straight into shared memory, instead of pickling them through pipes.
+        # The vector environment does not copy them, so the game copies every frame once, into its own buffer,
+        # only when the next step is started before the frame is processed.
+        if self.num_envs > 1:
+            environment = gym.vector.AsyncVectorEnv(env_fns, shared_memory=True, copy=False)
+        else:
+            environment = gym.vector.SyncVectorEnv(env_fns, copy=False)
 
         # Get the observation space's height and width.
-        height, width = environment.observation_space.shape[0], environment.observation_space.shape[1]
+        height, width = environment.single_observation_space.shape[0], environment.single_observation_space.shape[1]
         # Get the number of possible moves.
-        act_space_size = environment.action_space.n
+        act_space_size = environment.single_action_space.n
 
         return environment, height, width, act_space_size
 
-    def _begin_episode(self) -> np.ndarray:
+    def _begin_episodes(self, lanes: np.ndarray) -> None:
         """
-        Begins an episode.
+        Begins an episode in a number of environments, picking a number of no operation steps for each of them.
+        The environments themselves are reset by the vector environment, as soon as their previous episode finishes.
 
-        :return: the initial state.
+        :param lanes: the environments in which the episodes begin.
         """
-        # Reset and render the environment.
-        init_state = self._env.reset()
-        if self.render:
-            self._env.render()
-
-        return init_state
+        # Observe for a random number of steps picked from [1, self.no_operation], independently for every environment.
+        self._no_operations[lanes] = np.random.randint(1, self.no_operation + 1, len(lanes))
 
-    def _observe(self, init_state: np.ndarray) -> [np.ndarray, bool]:
+    def _stack_states(self, lanes: np.ndarray) -> np.ndarray:
         """
-        Take no action.
+        Stacks the states of a number of environments from the frames buffer, with the newest frames first.
 
-        :param init_state: the initial state.
-        :return: the next state and if game is done.
+        :param lanes: the environments whose states will be stacked.
+        :return: the states.
         """
-        # Init variables.
-        observe, done = init_state, False
-
-        # Observe for a random number of steps picked from [1, self._no_operation].
-        for _ in range(randint(1, self.no_operation)):
-            # Take no action.
-            observe, _, done, _ = self._env.step(0)
-            # Render the frame.
-            if self.render:
-                self._env.render()
+        return self._frames[lanes[:, np.newaxis], self._history_orders[self._head]]
 
-            if done:
-                break
-
-        return observe, done
-
-    def _pretrain_phase(self) -> np.ndarray:
+    def _observe(self, agent: DQN, observing: np.ndarray) -> None:
         """
-        Completes pretrain phase.
+        Counts down the no operation steps of the observing environments,
+        initializing the states of the environments which finished observing.
 
-        :return: the state that was created.
+        :param agent: the agent whose memory will hold the first frames.
+        :param observing: mask with the alive environments which took no action.
         """
-        # Start the episode.
-        init_state = self._begin_episode()
+        # Count down the no operation steps, which are taken in whole actions.
+        self._no_operations[observing] -= self.steps_per_action
+        started = observing & (self._no_operations <= 0)
 
-        # Just observe.
-        current_state, done = self._observe(init_state)
+        # Create preceding frames, by broadcasting the starting frame to the whole frame history.
+        self._frames[started] = self._frames[started, self._head:self._head + 1]
 
-        # Preprocess current_state.
-        current_state = atari_preprocess(current_state, self.downsample_scale)
+        # Save the starting frames to the replay memory.
+        if started.any():
+            agent.begin_memory_episodes(self._frames[started, self._head], np.flatnonzero(started))
 
-        # Create preceding frames, using the starting frame.
-        current_state = np.concatenate(tuple([current_state for _ in range(self.agent_frame_history)]), axis=1)
-
-        return current_state
-
-    def _take_frame_skipping_action(self, agent: DQN, current_state: np.ndarray, episode: int) -> _GameInfo:
+    def _take_frame_skipping_action(self, agent: DQN, alive: np.ndarray, episode: int) -> _GameInfo:
         """
-        Takes an action, using frame skipping.
-
-        :param agent: the agent to take the action.
-        :param current_state: the current state.
-        :param episode: the current episode.
-        :return: the next state, the reward and if game is done.
+        Takes an action in every alive environment, using frame skipping.
+        The environments which are still observing take no action instead.
+
+        :param agent: the agent to take the actions.
+        :param alive: mask with the environments whose episode has not finished yet.
+        :param episode: the episode being played.
+        :return: the rewards, the mask with the environments whose episode finished during the action
+         and the mask with the environments in which the agent took an action.
         """
-        # Let the agent take an action.
-        action = agent.take_action(current_state, episode)
+        # Split the alive environments to the observing ones and the ones played by the agent.
+        observing = alive & (self._no_operations > 0)
+        playing = alive & ~observing
+
+        # Let the agent take an action for every played environment, using a single batch.
+        actions = np.zeros(self.num_envs, dtype=np.int64)
+        if playing.any():
+            actions[playing] = agent.take_action(self._stack_states(np.flatnonzero(playing)), episode)
         # Init variables.
-        reward, next_state, done = 0, current_state, False
+        rewards, acting, was_alive = np.zeros(self.num_envs), playing, alive
+        # Bind the attributes used on every frame to locals, in order to avoid the repeated lookups.
+        step_async, step_wait, observations = self._env.step_async, self._env.step_wait, self._observations
+        render_frame, append_to_memory = self._render_frame, agent.append_batch_to_memory
+        frames_buffer, head, newest_frames = self._frames, self._head, self._newest_frames
+        downsample_scale, frame_history = self.downsample_scale, self.agent_frame_history
+
+        # Start a step in every environment, using the actions.
+        step_async(actions)
+
+        for step in range(1, self.steps_per_action + 1):
+            # Wait for the step of every environment.
+            frames, new_rewards, dones, _ = step_wait()
+            # Add rewards, only for the environments which are played by the agent.
+            rewards += new_rewards * acting
+            # Finished environments are reset automatically, so they should not be considered anymore.
+            # Their next episode takes no operation actions for the rest of the frames of this action.
+            alive = alive & ~dones
+            acting = acting & ~dones
+            actions[dones] = 0
+
+            if not alive.any():
+                # Render the frame.
+                render_frame(frames)
+                break
+
+            # Start the next step of the repeated action right away, so that the environments are stepped
+            # while the frames are being processed. The subprocess environments' frames are copied first.
+            if step < self.steps_per_action:
+                if observations is not None:
+                    np.copyto(observations, frames)
+                    frames = observations
+                step_async(actions)
 
-        for _ in range(self.steps_per_action):
-            # Take a step, using the action.
-            next_state, new_reward, done, _ = self._env.step(action)
             # Render the frame.
-            if self.render:
-                self._env.render()
-            # Add reward.
-            reward += new_reward
+            render_frame(frames)
 
-            if done:
-                break
+            # Move the write head to the oldest frames and preprocess the frames straight over them, as the newest ones.
+            head = (head + 1) % frame_history
+            atari_preprocess(frames, downsample_scale, newest_frames[head])
 
-            # Preprocess the state.
-            next_state = atari_preprocess(next_state, self.downsample_scale)
-            # Append the frame history.
-            next_state = np.append(next_state, current_state[:, :self.agent_frame_history - 1, :, :, :], axis=1)
+            # Save samples <s,a,r,s'> to the replay memory, for all the played environments at once.
+            # Only the newest frame is saved, because the states are stacked from the memory's frames when sampled.
+            lanes = np.flatnonzero(acting)
+            append_to_memory(frames_buffer[lanes, head], actions[lanes], rewards[lanes], lanes)
 
-            # Save sample <s,a,r,s'> to the replay memory.
-            agent.append_to_memory(current_state, action, reward, next_state)
+        self._head = head
 
-            # Set current state with the next.
-            current_state = next_state
+        # Update the observing environments.
+        self._observe(agent, observing & alive)
 
-        return next_state, reward, done
+        return rewards, was_alive & ~alive, playing
 
-    def _train_and_play(self, agent: DQN, current_state: np.ndarray, episode: int) -> _GameInfo:
+    def _wait_for_fit(self) -> None:
+        """ Waits for the currently running fit and keeps its loss, for every episode that was being played. """
+        if self._fitting is not None:
+            self._losses += self._fitting.result() * self._fitting_played
+            self._fitting = None
+
+    def _train_and_play(self, agent: DQN, alive: np.ndarray, episode: int) -> _GameInfo:
         """
-        Train the agent while playing, using the current state.
+        Train the agent while playing, using the current states.
 
         :param agent: the agent to train.
-        :param current_state: the current state.
-        :param episode: the current episode.
-        :return: the next state, the reward and if game is done.
+        :param alive: mask with the environments whose episode has not finished yet.
+        :param episode: the episode being played.
+        :return: the rewards, the mask with the environments whose episode finished
+         and the mask with the environments in which the agent took an action.
         """
         # Init variables.
-        reward, next_state, done = 0, current_state, False
+        rewards, played = np.zeros(self.num_envs), np.zeros(self.num_envs, dtype=bool)
 
         # Repeat actions before fitting time.
         for _ in range(self.fit_frequency):
             # Take an action.
-            next_state, new_reward, done = self._take_frame_skipping_action(agent, current_state, episode)
-            # Add reward.
-            reward += new_reward
-            if done:
+            new_rewards, finished, playing = self._take_frame_skipping_action(agent, alive, episode)
+            # Add rewards.
+            rewards += new_rewards
+            played |= playing
+            # Fit as soon as an episode finishes, so that the finished environments begin their next episode
+            # with the next action. The vector environment keeps stepping them with no operation actions until then,
+            # which would otherwise be added to the next episode's no operation steps.
+            if finished.any():
                 break
 
-        # Fit agent and keep fitting history.
-        fitting_history = agent.fit()
-        if fitting_history is not None:
-            self.scorer.huber_loss_history[episode - 1] += fitting_history.history['loss']
+        # Wait for the previous fit, before starting the next one.
+        self._wait_for_fit()
+        # Fit agent in the background, while the next actions are taken.
+        # The environments take their actions together, so the agent trains on the mini batches of every environment
+        # which was played, in order to keep the fits per action taken.
+        self._fitting, self._fitting_played = agent.fit(self._fit_executor, np.count_nonzero(played)), played
+
+        # Wait for the fit, if an episode finished, so that its loss is included in the finished episode's.
+        if finished.any():
+            self._wait_for_fit()
 
-        return next_state, reward, done
+        return rewards, finished, played
 
     def _game_loop(self, agent: DQN) -> Generator:
         """
         Starts the game loop and trains the agent.
+        Every environment plays its episodes independently, beginning the next one as soon as the previous finishes,
+        so that no environment waits for the others.
 
         :param agent: the agent to play the game.
         :return: generator containing the finished episode number.
         """
-        # Run for a number of episodes.
-        for episode in range(1, self.episodes + 1):
-            # Init vars.
-            reward, max_score, total_score, done = 0, -inf, 0, False
-            # Complete pretrain phase.
-            current_state = self._pretrain_phase()
-
-            while not done:
-                # Train the agent while playing.
-                current_state, reward, done = self._train_and_play(agent, current_state, episode)
-                # Add reward to the total score.
-                total_score += reward
-                # Set max score.
-                max_score = max(max_score, reward)
-
-            # Add scores to the scores arrays.
-            self.scorer.max_scores[episode - 1] = max_score
-            self.scorer.total_scores[episode - 1] = total_score
-
-            # Yield the finished episode.
-            yield episode
+        # Use only as many environments as the episodes.
+        started_episodes = min(self.num_envs, self.episodes)
+        alive = np.arange(self.num_envs) < started_episodes
+        finished_episodes = 0
+        # Init vars.
+        self._max_scores[:] = -inf
+        self._total_scores[:] = 0
+        self._losses[:] = 0
+        # Reset and render the environments and begin their episodes.
+        self._render_frame(self._env.reset())
+        self._begin_episodes(np.flatnonzero(alive))
+
+        while alive.any():
+            # Train the agent while playing.
+            rewards, finished, played = self._train_and_play(agent, alive, finished_episodes + 1)
+            # Add rewards to the total scores, in place.
+            self._total_scores += rewards
+            # Set max scores in place, for the environments which were played by the agent.
+            np.maximum(self._max_scores, rewards, out=self._max_scores, where=played)
+
+            if finished.any():
+                # Number the finished episodes in the order they finished and add their scores to the scores arrays.
+                lanes = np.flatnonzero(finished)
+                episodes = slice(finished_episodes, finished_episodes + len(lanes))
+                self.scorer.max_scores[episodes] = self._max_scores[lanes]
+                self.scorer.total_scores[episodes] = self._total_scores[lanes]
+                self.scorer.huber_loss_history[episodes] = self._losses[lanes]
+                # Reset the finished environments' scores.
+                self._max_scores[lanes] = -inf
+                self._total_scores[lanes] = 0
+                self._losses[lanes] = 0
+
+                # Begin the next episodes in as many of the finished environments as the remaining episodes
+                # and stop the rest of them. The vector environment cannot step only some of its environments,
+                # so the stopped ones keep being stepped with no operation actions, until every episode finishes.
+                beginning = lanes[:self.episodes - started_episodes]
+                self._begin_episodes(beginning)
+                alive[lanes[len(beginning):]] = False
+                started_episodes += len(beginning)
+
+                # Yield the finished episodes.
+                yield from range(finished_episodes + 1, finished_episodes + len(lanes) + 1)
+                finished_episodes += len(lanes)
+
+    def _wait_for_writes(self, finished_only: bool = False) -> None:
+        """
+        Waits for the pending writes, raising their errors.
+
+        :param finished_only: whether only the writes which have already finished should be waited for.
+        """
+        pending = []
+        for write in self._writes:
+            if finished_only and not write.done():
+                pending.append(write)
+            else:
+                write.result()
+
+        self._writes = pending
+
+    def _write(self, write: Future) -> None:
+        """
+        Keeps a pending write, raising the errors of the previous writes which have finished.
+
+        :param write: the future of the write.
+        """
+        self._wait_for_writes(finished_only=True)
+        self._writes.append(write)
 
     def _update_progressbar(self, finished_episode: int) -> None:
         """
@@ -274,8 +442,9 @@ class Game(object):
         # Save agent.
         if finished_episode % self.specs.agent_save_interval == 0 or self.specs.agent_save_interval == 1:
             print('Saving agent.')
-            filename = agent.save_agent("{}_{}".format(self.specs.agent_name_prefix, finished_episode))
-            print('Agent has been successfully saved as {}.'.format(filename))
+            saved = agent.save_agent("{}_{}".format(self.specs.agent_name_prefix, finished_episode), self._io_executor)
+            saved.add_done_callback(_report_saved_agent)
+            self._write(saved)
 
         # Show scores.
         if finished_episode % self.specs.info_interval_current == 0 or self.specs.info_interval_current == 1:
@@ -310,7 +479,7 @@ class Game(object):
         # Save results.
         if self.specs.results_save_interval > 0 and (
                 finished_episode % self.specs.results_save_interval == 0 or self.specs.results_save_interval == 1):
-            self.scorer.save_results(finished_episode)
+            self._write(self._io_executor.submit(self.scorer.save_results, finished_episode))
 
     def play_game(self, agent: DQN) -> None:
         """
@@ -325,3 +494,13 @@ class Game(object):
         for finished_episode in self._game_loop(agent):
             # Take specific actions after the end of each episode.
             self._end_of_episode_actions(finished_episode, agent)
+
+        # Wait for the pending saves and close the workers, the environments and the renderer.
+        self._fit_executor.shutdown()
+        self._io_executor.shutdown()
+        self._env.close()
+        if self.render:
+            self._renderer.close()
+
+        # Raise the errors of the saves, if any.
+        self._wait_for_writes()
@@ -0,0 +1,50 @@
+from queue import Queue
+from threading import Thread
+
+import numpy as np
+from gym.envs.classic_control.rendering import SimpleImageViewer
+
+
+class Renderer(object):
+    """
+    Shows the game's frames from a background thread, so that the game never waits for them to be drawn.
+    The viewer is created and driven by that thread, which is not supported on macOS,
+    where windows can only be used from the main thread.
+    """
+
+    def __init__(self, max_queued_frames: int = 1):
+        # Initialize the queue of frames waiting to be shown.
+        self._frames = Queue(max_queued_frames)
+        # Start the thread which shows the frames.
+        self._thread = Thread(target=self._show_frames, name='renderer', daemon=True)
+        self._thread.start()
+
+    def _show_frames(self) -> None:
+        """ Shows the queued frames, until the renderer is closed. """
+        viewer = SimpleImageViewer()
+
+        # A None frame means that the renderer has been closed.
+        frame = self._frames.get()
+        while frame is not None:
+            viewer.imshow(frame)
+            frame = self._frames.get()
+
+        viewer.close()
+
+    def render(self, frames: np.ndarray) -> None:
+        """
+        Queues the first environment's frame to be shown.
+        The frame is dropped if the previous frames have not been shown yet.
+
+        :param frames: the frames of every environment.
+        """
+        # Check for room before copying the frame, so that the dropped frames are not copied at all.
+        # The check cannot be invalidated before the put, because the frames are only queued from this thread.
+        if not self._frames.full():
+            # Copy the frame, because the environments reuse the observations' array.
+            self._frames.put_nowait(frames[0].copy())
+
+    def close(self) -> None:
+        """ Closes the renderer, after showing the queued frames. """
+        self._frames.put(None)
+        self._thread.join()
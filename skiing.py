@@ -2,12 +2,11 @@ from os import path
 from warnings import warn
 
 from core.agent import DQN, load_dqn_agent
-from core.model import atari_skiing_model, huber_loss, frame_can_pass_the_net, MIN_FRAME_DIM_THAT_PASSES_NET, \
-    initialize_optimizer
+from core.model import atari_skiing_model, frame_can_pass_the_net, MIN_FRAME_DIM_THAT_PASSES_NET, initialize_optimizer
 from core.policy import EGreedyPolicy
 from game_engine.game import Game, GameResultSpecs
 from utils.parser import create_parser
-from utils.system_operations import create_path
+from utils.system_operations import create_path, enable_gpu_memory_growth
 
 
 def run_checks() -> None:
@@ -41,11 +40,15 @@ def run_checks() -> None:
 
     # Downsampling should result with at least 32 pixels on each dimension,
     # because the first convolutional layer has a filter 8x8 with stride 4x4.
-    if not frame_can_pass_the_net(game.observation_space_shape[1], game.observation_space_shape[2]):
+    if not frame_can_pass_the_net(game.downsampled_rows, game.downsampled_columns):
         raise ValueError('Downsample is too big. It can be set from 1 to {}'
                          .format(min(int(game.pixel_rows / MIN_FRAME_DIM_THAT_PASSES_NET),
                                      int(game.pixel_columns / MIN_FRAME_DIM_THAT_PASSES_NET))))
 
+    if args.num_envs > episodes:
+        warn('The number of environments ({}) is greater than the episodes ({}). '
+             'Only {} environments will be used.'.format(args.num_envs, episodes, episodes))
+
     if plot_train_results and episodes == 1:
         warn('Cannot plot for 1 episode only.')
 
@@ -69,12 +72,12 @@ def run_checks() -> None:
         warn('The total number of observing steps ({}) is too small and could bring poor results.'
              'Consider a value grater than {}'.format(total_observe_count, poor_observe))
 
-    final_memory_size = agent.memory.end + total_observe_count
+    final_memory_size = len(agent.memory) + total_observe_count
     if final_memory_size < batch_size:
         raise ValueError('The total number of observing steps ({}) '
                          'cannot be smaller than the agent\'s memory size ( current = {}, final = {} )'
                          ' after the observing steps ({}).'
-                         .format(total_observe_count, agent.memory.end, final_memory_size,
+                         .format(total_observe_count, len(agent.memory), final_memory_size,
                                  total_observe_count))
 
 
@@ -90,7 +93,7 @@ def create_agent() -> DQN:
     """
     if agent_path != '':
         # Load the agent.
-        dqn = load_dqn_agent(agent_path, {'huber_loss': huber_loss})
+        dqn = load_dqn_agent(agent_path, optimizer)
 
         # Check for agent configuration conflicts.
         if dqn.observation_space_shape != game.observation_space_shape:
@@ -107,6 +110,7 @@ def create_agent() -> DQN:
         dqn.target_model_change = target_model_change
         dqn.gamma = gamma
         dqn.batch_size = batch_size
+        dqn.fit_batches = fit_batches
         dqn.policy = policy
         print('Agent {} has been loaded successfully.'.format(agent_path))
     else:
@@ -114,7 +118,7 @@ def create_agent() -> DQN:
         model = atari_skiing_model(game.observation_space_shape, game.action_space_size, optimizer)
         # Create the agent.
         dqn = DQN(model, target_model_change, gamma, batch_size, game.observation_space_shape,
-                  game.action_space_size, policy, memory_size=replay_memory_size)
+                  game.action_space_size, policy, memory_size=replay_memory_size, fit_batches=fit_batches)
 
     return dqn
 
@@ -142,12 +146,15 @@ if __name__ == '__main__':
     fit_frequency = args.fit_frequency
     no_operation = args.no_operation
     episodes = args.episodes
+    # Use only as many environments as the episodes.
+    num_envs = min(args.num_envs, episodes)
     epsilon = args.epsilon
     final_epsilon = args.final_epsilon
     epsilon_decay = args.decay
     total_observe_count = args.observe
     replay_memory_size = args.replay_memory
     batch_size = args.batch
+    fit_batches = args.fit_batches
     gamma = args.gamma
     optimizer_name = args.optimizer
     learning_rate = args.learning_rate
@@ -158,13 +165,16 @@ if __name__ == '__main__':
     fuzz = args.fuzz
     momentum = args.momentum
 
+    # Let the GPUs' memory grow as needed, before TensorFlow initializes them.
+    enable_gpu_memory_growth()
+
     # Create the game specs.
     game_specs = GameResultSpecs(info_interval_current, info_interval_mean, agent_save_interval, results_save_interval,
                                  plots_name_prefix, results_name_prefix, agent_name_prefix, recording_name_prefix,
                                  plot_train_results, save_plots)
 
     # Create the game.
-    game = Game(episodes, downsample_scale, agent_frame_history, steps_per_action, fit_frequency,
+    game = Game(episodes, num_envs, downsample_scale, agent_frame_history, steps_per_action, fit_frequency,
                 no_operation, game_specs, render, record)
 
     # Create the optimizer.
@@ -1,4 +1,5 @@
 from argparse import ArgumentParser, ArgumentTypeError
+from os import cpu_count
 
 FILENAME_PREFIX = 'out/models/atari_skiing'
 PLOT_NAME_PREFIX = 'out/plots/atari_skiing'
@@ -20,12 +21,14 @@ STEPS_PER_ACTION = 4
 FIT_FREQUENCY = 4
 NO_OPERATION = 30
 EPISODES = int(1E4)
+NUM_ENVS = cpu_count() or 1
 EPSILON = 1.
 FINAL_EPSILON = .1
 EPSILON_DECAY = float(1E-4)
 TOTAL_OBSERVE_COUNT = int(1E4)
 REPLAY_MEMORY_SIZE = int(4E5)
 BATCH_SIZE = 32
+FIT_BATCHES = 1
 GAMMA = .99
 OPTIMIZER_NAME = 'RMSProp'
 OPTIMIZER_CHOICES = 'adam', 'rmsprop', 'sgd', 'adagrad', 'adadelta', 'adamax'
@@ -106,7 +109,8 @@ def create_parser() -> ArgumentParser:
     parser.add_argument('-p', '--plot_name', type=str, required=False, default=PLOT_NAME_PREFIX,
                         help='Filename prefix for the plots to be saved (default %(default)s).')
     parser.add_argument('-nr', '--no_render', default=not RENDER, required=False, action='store_true',
-                        help='Whether the environment should not be rendered.')
+                        help='Whether the environment should not be rendered. '
+                             'The frames are rendered from a background thread, which is not supported on macOS.')
     parser.add_argument('-rec', '--record', default=RECORD, required=False, action='store_true',
                         help='Whether the game should be recorded. '
                              'Please note that you need to have ffmpeg in your path!')
@@ -115,12 +119,16 @@ def create_parser() -> ArgumentParser:
     parser.add_argument('-fs', '--frame_skipping', type=positive_int, default=STEPS_PER_ACTION, required=False,
                         help='The frames to skip per action (default %(default)s).')
     parser.add_argument('-ff', '--fit_frequency', type=positive_int, default=FIT_FREQUENCY, required=False,
-                        help='The actions to take between an agent\'s fit (default %(default)s).')
+                        help='The actions to take in every environment between an agent\'s fit '
+                             '(default %(default)s).')
     parser.add_argument('-no', '--no_operation', type=positive_int, default=NO_OPERATION, required=False,
                         help='The maximum number of no operation steps at the beginning of the game '
                              '(default %(default)s).')
     parser.add_argument('-e', '--episodes', type=positive_int, default=EPISODES, required=False,
                         help='The episodes to run the training procedure (default %(default)s).')
+    parser.add_argument('-ne', '--num_envs', type=positive_int, default=NUM_ENVS, required=False,
+                        help='The number of environments to be played in parallel, each one in its own process '
+                             '(default one per CPU core).')
     parser.add_argument('-eps', '--epsilon', type=positive_float, default=EPSILON, required=False,
                         help='The epsilon for the e-greedy policy (default %(default)s).')
     parser.add_argument('-feps', '--final_epsilon', type=positive_float, default=FINAL_EPSILON, required=False,
@@ -135,6 +143,9 @@ def create_parser() -> ArgumentParser:
     parser.add_argument('-b', '--batch', type=positive_int, default=BATCH_SIZE, required=False,
                         help='The batch size to be randomly sampled from the memory for the training '
                              '(default %(default)s).')
+    parser.add_argument('-fb', '--fit_batches', type=positive_int, default=FIT_BATCHES, required=False,
+                        help='The number of batches to be sampled and trained on every time the agent fits, '
+                             'for every environment, with a single compiled call (default %(default)s).')
     parser.add_argument('-g', '--gamma', type=positive_float, default=GAMMA, required=False,
                         help='The discount factor (default %(default)s).')
     parser.add_argument('-opt', '--optimizer', type=str.lower, default=OPTIMIZER_NAME, required=False,
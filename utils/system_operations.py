@@ -1,6 +1,8 @@
 import sys
 from os import makedirs, path
 
+import tensorflow as tf
+
 
 def create_path(filepath: str) -> None:
     """
@@ -16,6 +18,15 @@ def create_path(filepath: str) -> None:
         makedirs(directory)
 
 
+def enable_gpu_memory_growth() -> None:
+    """
+    Lets TensorFlow allocate the GPUs' memory as it is needed, instead of reserving all of it at once.
+    Must be called before any GPU is initialized.
+    """
+    for gpu in tf.config.list_physical_devices('GPU'):
+        tf.config.experimental.set_memory_growth(gpu, True)
+
+
 def print_progressbar(iteration: int, total: int, prefix: str = '', suffix: str = '', decimals: int = 0,
                       length: int = 50, fill: str = '='):
     """